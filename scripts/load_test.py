@@ -0,0 +1,55 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import statistics
+import time
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+
+def timed_search(url, query, limit):
+    start_time = time.perf_counter()
+    with urlopen(f"{url}/pages?{urlencode({'q': query, 'limit': limit})}") as response:
+        json.load(response)
+    return time.perf_counter() - start_time
+
+
+def cache_stats(url):
+    with urlopen(f"{url}/stats") as response:
+        return json.load(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure pdf-search server latency")
+    parser.add_argument("queries", type=argparse.FileType("r"), help="One search query per line")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Server address")
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=1000, help="Total number of requests")
+    parser.add_argument("--limit", type=int, default=10, help="Number of pages per query")
+
+    args = parser.parse_args()
+    queries = [line.strip() for line in args.queries if line.strip()]
+    if not queries:
+        parser.error("no queries found")
+    requests = list(itertools.islice(itertools.cycle(queries), args.requests))
+    stats_before = cache_stats(args.url)
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        latencies = list(
+            executor.map(lambda query: timed_search(args.url, query, args.limit), requests)
+        )
+    duration = time.perf_counter() - start_time
+    stats_after = cache_stats(args.url)
+    hits = stats_after["hits"] - stats_before["hits"]
+    lookups = hits + stats_after["misses"] - stats_before["misses"]
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    print(f"Requests:   {len(latencies)} with {args.clients} clients in {duration:.2f} seconds")
+    print(f"Throughput: {len(latencies) / duration:.1f} requests/sec")
+    print(f"Latency:    p50 {percentiles[49] * 1000:.1f} ms, p99 {percentiles[98] * 1000:.1f} ms")
+    ## Cached queries only measure a dict lookup, serve with --cache-size 0 to measure searching
+    print(f"Cache:      {hits}/{lookups} hits ({hits / lookups if lookups else 0:.0%})")
+
+
+if __name__ == "__main__":
+    main()
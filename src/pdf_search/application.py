@@ -1,8 +1,10 @@
 import argparse
+import contextlib
+import json
 import pathlib
 import math
-import msvcrt
 import os
+import sys
 import time
 from typing import List
 import webbrowser
@@ -17,24 +19,218 @@ from rich.text import Text
 from rich.panel import Panel
 from rich.columns import Columns
 
-from . import pdf
-from .vault import Vault, PDF_TYPES
-from .console import console
+from .federation import VaultGroup
+from .preview import preview_document_page
+from .vault import Vault, MERGE_POLICIES, PDF_TYPES
+from .console import console, error_console
 
 
 def main():
     parser = argparse.ArgumentParser(description="Search through your local pdfs")
-    parser.add_argument("command", choices=["interactive"], help="Start pdf-search console")
-    parser.add_argument("--vault", type=pathlib.Path, default="./vault", help="path")
+    parser.add_argument(
+        "command",
+        choices=["interactive", "search", "serve", "maintain", "reindex"],
+        help="Start pdf-search console, run a batch of search queries, serve or maintain the vault",
+    )
+    parser.add_argument(
+        "--vault",
+        type=pathlib.Path,
+        nargs="+",
+        default=[pathlib.Path("./vault")],
+        help="Path to the vault, several vaults are searched together by interactive and search",
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=256, help="Number of search results to cache"
+    )
+    parser.add_argument(
+        "--persist-cache", action="store_true", help="Keep the search cache inside the vault"
+    )
+    parser.add_argument(
+        "--queries",
+        default="-",
+        help="File with one search query per line, defaults to stdin",
+    )
+    parser.add_argument(
+        "--output",
+        default="-",
+        help="File to write the JSON Lines results to, defaults to stdout",
+    )
+    parser.add_argument("--limit", type=int, default=10, help="Number of pages per query")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to serve the vault on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to serve the vault on")
+    parser.add_argument(
+        "--searchers", type=int, default=4, help="Number of index searchers shared by the server"
+    )
+    parser.add_argument(
+        "--merge",
+        choices=MERGE_POLICIES.keys(),
+        default="small",
+        help="Segment merge policy used by maintain",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only report the index health and orphans"
+    )
+    parser.add_argument(
+        "--procs", type=int, default=None, help="Number of processes used by reindex"
+    )
+    parser.add_argument(
+        "--allow-missing",
+        action="store_true",
+        help="Reindex even if some files have no stored text, their pages are dropped",
+    )
 
     args = parser.parse_args()
     match args.command:
         case "interactive":
-            run_console_loop(args.vault)
+            run_console_loop(args.vault, args.cache_size, args.persist_cache)
+        case "search":
+            run_batch_search(args.vault, args.queries, args.output, args.limit, args.cache_size)
+        case "serve":
+            from .server import run_server
+
+            run_server(args.vault[0], args.host, args.port, args.searchers, args.cache_size)
+        case "maintain":
+            run_maintenance(args.vault[0], args.merge, args.dry_run)
+        case "reindex":
+            run_reindex(args.vault[0], args.procs, args.allow_missing)
 
 
-def run_console_loop(vault_path: pathlib.Path):
+def health_table(health, title):
+    table = Table(title=title)
+    table.add_column("Index")
+    table.add_column("Segments", justify="right")
+    table.add_column("Documents", justify="right")
+    table.add_column("Deleted", justify="right")
+    table.add_column("Size", justify="right")
+    for indexname, stats in health.items():
+        table.add_row(
+            indexname,
+            str(stats["segments"]),
+            str(stats["documents"]),
+            f"{stats['deleted']} ({stats['deleted_ratio']:.0%})",
+            f"{stats['size'] / 2**20:.2f} MB",
+        )
+    return table
+
+
+def run_maintenance(vault_path: pathlib.Path, merge="small", dry_run=False):
+    if not (vault_path / "index").is_dir():
+        console.print(f"Error: No vault found at {vault_path}", style="bold red")
+        return
     vault = Vault(vault_path)
+    console.print(health_table(vault.index_health(), "Index health"))
+    start_time = time.time()
+    orphans, files_deleted, pages_deleted = vault.maintain_index(merge, dry_run)
+    duration = time.time() - start_time
+    console.print(f"Found {len(orphans['pages'])} files in the pages index without a file index")
+    console.print(f"Found {len(orphans['files'])} files in the file index without a pdf file")
+    if orphans["untracked"]:
+        console.print(
+            f"Warning: Found {len(orphans['untracked'])} pdf files missing from the index",
+            style="yellow",
+        )
+        for idx, pdf_file_path in enumerate(orphans["untracked"]):
+            console.print(f"{idx + 1:6}. {pdf_file_path.as_posix()}")
+    if not dry_run:
+        console.print(
+            f"Deleted {files_deleted} file index and {pages_deleted} pages index,"
+            f" merged segments with the {merge} policy in {duration:.2f} seconds"
+        )
+        console.print(health_table(vault.index_health(), "Index health after maintenance"))
+
+
+def run_batch_search(
+    vault_paths: list[pathlib.Path], queries_path="-", output_path="-", limit=10, cache_size=256
+):
+    for vault_path in vault_paths:
+        if not (vault_path / "index").is_dir():
+            error_console.print(f"Error: No vault found at {vault_path}", style="bold red")
+            sys.exit(1)
+    with contextlib.ExitStack() as stack:
+        try:
+            queries_file = (
+                sys.stdin if queries_path == "-" else stack.enter_context(open(queries_path))
+            )
+            output_file = (
+                sys.stdout if output_path == "-" else stack.enter_context(open(output_path, "w"))
+            )
+        except OSError as e:
+            error_console.print(f"Error: {e}", style="bold red")
+            sys.exit(1)
+        vault_group = VaultGroup(vault_paths, query_cache_size=cache_size)
+        count = 0
+        failed = 0
+        start_time = time.perf_counter()
+        for line in queries_file:
+            query_str = line.strip()
+            if not query_str:
+                continue
+            count += 1
+            try:
+                pages = vault_group.search_pages(query_str, limit=limit)
+            except Exception as e:
+                output_file.write(json.dumps({"query": query_str, "error": str(e)}) + "\n")
+                failed += 1
+                continue
+            for rank, page in enumerate(pages):
+                result = {"query": query_str, "rank": rank + 1, **page}
+                output_file.write(json.dumps(result) + "\n")
+            output_file.flush()
+        duration = time.perf_counter() - start_time
+    cache_hits = sum(stats["hits"] for stats in vault_group.query_cache_stats().values())
+    vault_group.close()
+    error_console.print(
+        f"Ran {count} queries in {duration:.2f} seconds"
+        f" ({count / duration if duration else 0:.1f} queries/sec,"
+        f" {cache_hits} cache hits)"
+    )
+    if failed:
+        error_console.print(f"Error: {failed} queries failed", style="bold red")
+        sys.exit(1)
+
+
+def run_reindex(vault_path: pathlib.Path, procs=None, allow_missing=False):
+    if not (vault_path / "index").is_dir():
+        console.print(f"Error: No vault found at {vault_path}", style="bold red")
+        return
+    vault = Vault(vault_path)
+    start_time = time.time()
+    try:
+        files_indexed, pages_indexed, missing = vault.reindex(
+            procs,
+            allow_missing,
+            track=lambda x: track(x, "Reindexing", transient=True, console=console),
+        )
+    except Exception as e:
+        console.print(f"Error: {e}", style="bold red")
+        return
+    duration = (time.time() - start_time) / 60  ## minutes
+    console.print(
+        f"Reindexed {files_indexed} files and {pages_indexed} pages in {duration:.2f} minutes"
+    )
+    if missing:
+        console.print(f"Warning: Dropped {len(missing)} files without stored text", style="yellow")
+        for idx, file_id in enumerate(missing):
+            console.print(f"{idx + 1:6}. {file_id}")
+
+
+def preview_file(vault: Vault, file, neighbours=()):
+    ## The selected file is queued before its neighbours so it is rendered first
+    for f in [file, *neighbours]:
+        if not f.get("deleted"):
+            vault.prefetch_page(f["id"], f["type"], f["filename"])
+    return vault.preview_page(file["id"], file["type"], file["filename"])
+
+
+def run_console_loop(vault_paths: list[pathlib.Path], cache_size=256, persist_cache=False):
+    from . import pdf
+
+    ## Searches run on all the vaults, every other command uses the first vault
+    vault_group = VaultGroup(
+        vault_paths, query_cache_size=cache_size, persist_query_cache=persist_cache
+    )
+    vault = vault_group.primary
+    vault_path = vault.vault_path
     if vault.status_ok:
         while True:
             command = command_parser(console.input("> "))
@@ -75,15 +271,26 @@ def run_console_loop(vault_path: pathlib.Path):
                         ## "type: <docs|papers|book|thesis>"
                         ## space seperated words are treated as exact keywords in text
                         query_str = " ".join(rest)
-                        pages = vault.search_pages(query_str, limit=100)
-                        console_loop_search_panel(pages, vault.get_pdf_url)
+                        pages = vault_group.search_pages(query_str, limit=100)
+                        console_loop_search_panel(
+                            pages,
+                            vault_group.get_pdf_url,
+                            len(vault_group.vaults) > 1,
+                            vault_group.preview_page,
+                        )
+                        vault_group.cancel_previews()
                     else:
                         console.print("Error: missing search query", style="bold red")
                 case ["browse"]:
                     files = vault.list_all_files()
                     console_loop_browse_panel(
-                        files, vault.get_pdf_url, vault.remove_file_index, vault.get_pdf_filepath
+                        files,
+                        vault.get_pdf_url,
+                        vault.remove_file_index,
+                        vault.get_pdf_filepath,
+                        lambda file, neighbours: preview_file(vault, file, neighbours),
                     )
+                    vault.cancel_previews()
                 case ["import", *rest]:
                     if rest:
                         import_dir_path = pathlib.Path(rest[0])
@@ -117,6 +324,7 @@ def run_console_loop(vault_path: pathlib.Path):
                         choices=["yes", "no"],
                     )
                     if response == "yes":
+                        vault_group.close()
                         vault.nuke()
                         console.print("Vault has been deleted!")
                         return
@@ -135,7 +343,17 @@ def run_console_loop(vault_path: pathlib.Path):
                     )
                     console.print("    [blue]browse[/]\t\tBrowse through the files in the vault")
                     console.print("    [blue]import <path>[/]\tImport several files at once")
+                    console.print("    [blue]cache[/]\t\tShow the search cache statistics")
+                case ["cache"]:
+                    for vault_name, stats in vault_group.query_cache_stats().items():
+                        console.print(
+                            f"Cache {vault_name}: {stats['size']}/{stats['maxsize']} entries,"
+                            f" {stats['hits']} hits, {stats['misses']} misses"
+                            f" ({stats['hit_ratio']:.0%} hit ratio)"
+                        )
                 case ["quit"]:
+                    vault_group.save_query_caches()
+                    vault_group.close()
                     return
                 case _:
                     console.print(f"Error: invalid command {command}", style="bold red")
@@ -161,17 +379,24 @@ def command_parser(input_str: str) -> List[str]:
     return args
 
 
-def search_panel(pages, selected, page_idx, page_count):
+def search_panel(pages, selected, page_idx, page_count, show_vault=False, preview=None):
     display = Layout()
     if pages:
         pages_table = Table()
         pages_table.add_column("Page")
         pages_table.add_column("Type")
+        if show_vault:
+            pages_table.add_column("Vault")
         pages_table.add_column(f"File [{page_idx + 1}/{page_count}]")
         for i, page in enumerate(pages):
             style = "blue" if i == selected else ""
+            vault_column = [page["vault"]] if show_vault else []
             pages_table.add_row(
-                str(page["page_number"]), page["pdf_type"], page["filename"], style=style
+                str(page["page_number"]),
+                page["pdf_type"],
+                *vault_column,
+                page["filename"],
+                style=style,
             )
     else:
         pages_table = Text("No pages found!")
@@ -181,11 +406,15 @@ def search_panel(pages, selected, page_idx, page_count):
     pages_panel = Panel(pages_table, title="Pages")
     action_layout = Layout(action_panel, ratio=1)
     pages_layout = Layout(pages_panel, ratio=5)
-    display.split_row(action_layout, pages_layout)
+    if preview is not None:
+        preview_layout = Layout(Panel(preview, title="Preview", expand=False), ratio=2)
+        display.split_row(action_layout, pages_layout, preview_layout)
+    else:
+        display.split_row(action_layout, pages_layout)
     return display
 
 
-def browse_panel(pages, pdf_type, selected_idx, page_idx, page_count):
+def browse_panel(pages, pdf_type, selected_idx, page_idx, page_count, preview=None):
     display = Layout()
     if pages:
         pages_table = Table()
@@ -206,75 +435,131 @@ def browse_panel(pages, pdf_type, selected_idx, page_idx, page_count):
     action_layout = Layout(action_panel, ratio=1)
     pages_layout = Layout(pages_panel, ratio=4)
     details_layout = Layout(details_panel, ratio=2)
-    display.split_row(action_layout, pages_layout, details_layout)
+    if preview is not None:
+        preview_layout = Layout(Panel(preview, title="Preview", expand=False), ratio=2)
+        display.split_row(action_layout, pages_layout, details_layout, preview_layout)
+    else:
+        display.split_row(action_layout, pages_layout, details_layout)
     return display
 
 
-def import_pdf_files(vault, import_dir_path):
+IMPORT_SCHEMA = {
+    "filename": str,
+    "type": str,
+    "author": str,
+    "title": str,
+    "year": str,
+    "edition": str,
+    "ISBN10": str,
+    "ISBN13": str,
+    "DOI": str,
+    "journal": str,
+    "volume": str,
+    "pageRange": str,
+    "keywords": str,
+    "course": str,
+}
+IMPORT_DETAILS_FILENAMES = ["details.xlsx", "details.csv", "details.parquet"]
+IMPORT_CHUNK_SIZE = 1000
+
+
+def find_import_details(import_dir_path: pathlib.Path) -> pathlib.Path:
+    for details_filename in IMPORT_DETAILS_FILENAMES:
+        details_path = import_dir_path / details_filename
+        if details_path.is_file():
+            return details_path
+    raise FileNotFoundError(
+        f"Import details not found, expected one of: {', '.join(IMPORT_DETAILS_FILENAMES)}"
+    )
+
+
+def normalize_import_details(details):
+    ## Every column is read as text by its name, empty cells are empty strings
+    return details.select(pl.all().cast(pl.Utf8).fill_null(""))
+
+
+def scan_import_details(details_path: pathlib.Path) -> pl.LazyFrame:
+    match details_path.suffix:
+        case ".csv":
+            details = pl.scan_csv(details_path, infer_schema_length=0)
+        case ".parquet":
+            details = pl.scan_parquet(details_path)
+        case _:
+            details = pl.read_excel(
+                details_path,
+                read_csv_options={"dtypes": IMPORT_SCHEMA, "missing_utf8_is_empty_string": True},
+            ).lazy()
+    return normalize_import_details(details)
+
+
+def iter_import_details(
+    details_path: pathlib.Path, details: pl.LazyFrame, chunk_size=IMPORT_CHUNK_SIZE
+):
+    ## CSV is streamed from disk, xlsx is already in memory and parquet is read once
+    if details_path.suffix == ".csv":
+        ## dtypes are matched by position in batched reads, columns are typed by name instead
+        reader = pl.read_csv_batched(details_path, infer_schema_length=0, batch_size=chunk_size)
+        while batches := reader.next_batches(1):
+            for batch in batches:
+                yield from normalize_import_details(batch).iter_rows(named=True)
+    else:
+        for chunk in details.collect().iter_slices(n_rows=chunk_size):
+            yield from chunk.iter_rows(named=True)
+
+
+def import_pdf_files(vault, import_dir_path, chunk_size=IMPORT_CHUNK_SIZE):
+    from . import pdf
+
     if not import_dir_path.exists():
         raise FileNotFoundError(f"Import directory not found: {import_dir_path}")
     pdf_dir_path = import_dir_path / "files"
-    excel_path = import_dir_path / "details.xlsx"
-    import_schema = {
-        "filename": str,
-        "type": str,
-        "author": str,
-        "title": str,
-        "year": str,
-        "edition": str,
-        "ISBN10": str,
-        "ISBN13": str,
-        "DOI": str,
-        "journal": str,
-        "volume": str,
-        "pageRange": str,
-        "keywords": str,
-        "course": str,
-    }
-    df = pl.read_excel(
-        excel_path, read_csv_options={"dtypes": import_schema, "missing_utf8_is_empty_string": True}
+    details_path = find_import_details(import_dir_path)
+    details = scan_import_details(details_path)
+    details_filenames = (
+        details.select(pl.col("filename") + ".pdf").unique().collect().get_column("filename")
     )
-    files_filenames = set(os.listdir(pdf_dir_path))
-    details_filenames = set(df["filename"].map_elements(lambda filename: f"{filename}.pdf"))
-    missing_pdfs = details_filenames - files_filenames
+    files_filenames = pl.Series("filename", os.listdir(pdf_dir_path), dtype=pl.Utf8)
+    missing_pdfs = set(details_filenames.filter(~details_filenames.is_in(files_filenames)))
     if missing_pdfs:
         console.print(f"Warning: Found {len(missing_pdfs)} missing pdf files", style="yellow")
         for idx, pdf_filename in enumerate(missing_pdfs):
             console.print(f"{idx + 1:6}. {pdf_filename}")
-    missing_details = files_filenames - details_filenames
-    if missing_details:
+    missing_details = files_filenames.filter(~files_filenames.is_in(details_filenames))
+    if len(missing_details):
         console.print(f"Warning: Found {len(missing_details)} missing details", style="yellow")
         for idx, pdf_filename in enumerate(missing_details):
             console.print(f"{idx + 1:6}. {pdf_filename}")
-    rows = df.rows(named=True)
-    tot = len(rows)
+    tot = details.select(pl.count()).collect().item()
     errors = {}
 
-    duplicate_filenames = []
-    import_file_names = files_filenames - missing_details
-    import_file_ids = set()
+    import_file_names = files_filenames.filter(files_filenames.is_in(details_filenames))
+    import_file_ids = []
     for filename in import_file_names:
         pdf_file_path = pdf_dir_path / filename
         try:
             pdf_file = pdf.PdfFile(vault, pdf_file_path)
-            import_file_ids.add(pdf_file.file_hash)
+            import_file_ids.append(pdf_file.file_hash)
         except Exception as e:
             console.print(f"Cannot hash {filename}: {e}")
-    vault_files = vault.list_all_files()
-    for fs in vault_files.values():
-        for f in fs:
-            if f["id"] in import_file_ids:
-                duplicate_filenames.append(f["filename"])
-    if duplicate_filenames:
+    vault_files = pl.DataFrame(
+        [
+            {"id": f["id"], "filename": f["filename"]}
+            for fs in vault.list_all_files().values()
+            for f in fs
+        ],
+        schema={"id": pl.Utf8, "filename": pl.Utf8},
+    )
+    duplicate_filenames = vault_files.filter(pl.col("id").is_in(import_file_ids))["filename"]
+    if len(duplicate_filenames):
         console.print(f"Warning: Found {len(duplicate_filenames)} duplicate files", style="yellow")
         for idx, pdf_filename in enumerate(duplicate_filenames):
             console.print(f"{idx + 1:6}. {pdf_filename}")
 
-    for idx, record in enumerate(rows):
+    for idx, record in enumerate(iter_import_details(details_path, details, chunk_size)):
         filename = record["filename"]
         errors[filename] = []
         try:
-            if filename not in missing_pdfs:
+            if f"{filename}.pdf" not in missing_pdfs:
                 pdf_file_path = pdf_dir_path / f"{filename}.pdf"
                 with Progress(
                     TextColumn(f"[green][{idx+1}/{tot}][/] [blue]Reading -[/] {filename[:40]}..."),
@@ -319,6 +604,8 @@ def import_pdf_files(vault, import_dir_path):
                 ) as progress:
                     progress.add_task("Writing")
                     pdf_file.write()
+            else:
+                errors[filename].append(f"PDF file not found: {filename}.pdf")
         except Exception as e:
             errors[filename].append(e)
         finally:
@@ -327,7 +614,9 @@ def import_pdf_files(vault, import_dir_path):
     return tot, errors
 
 
-def console_loop_search_panel(pages, get_pdf_url):
+def console_loop_search_panel(pages, get_pdf_url, show_vault=False, preview_page=None):
+    import msvcrt
+
     length = len(pages)
     selected = 0
     page_len = 10
@@ -336,13 +625,19 @@ def console_loop_search_panel(pages, get_pdf_url):
     start = page * page_len
     end = (page + 1) * page_len
     with Live(
-        search_panel(pages[start:end], selected, page, page_count),
+        search_panel(pages[start:end], selected, page, page_count, show_vault),
         transient=True,
         auto_refresh=False,
     ) as live:
         while True:
+            preview = None
+            if length and preview_page:
+                current = pages[start:end]
+                neighbours = current[max(selected - 1, 0) : selected]
+                neighbours += current[selected + 1 : selected + 2]
+                preview = preview_page(current[selected], neighbours)
             live.update(
-                search_panel(pages[start:end], selected, page, page_count),
+                search_panel(pages[start:end], selected, page, page_count, show_vault, preview),
                 refresh=True,
             )
             key = msvcrt.getch()
@@ -373,14 +668,19 @@ def console_loop_search_panel(pages, get_pdf_url):
                         filename = pages[start:end][selected]["filename"]
                         pdf_type = pages[start:end][selected]["pdf_type"]
                         page_number = pages[start:end][selected]["page_number"]
-                        file_url = get_pdf_url(pdf_type, filename)
+                        vault_name = pages[start:end][selected]["vault"]
+                        file_url = get_pdf_url(pdf_type, filename, vault_name)
                         url = f"{file_url}#page={page_number}"
                         browser.open(url)
                 case _:
                     continue
 
 
-def console_loop_browse_panel(files, get_pdf_url, remove_file_index, get_file_path):
+def console_loop_browse_panel(
+    files, get_pdf_url, remove_file_index, get_file_path, preview_file=None
+):
+    import msvcrt
+
     types = list(files.keys())
     t_len = len(types)
     p_len = 10
@@ -406,6 +706,12 @@ def console_loop_browse_panel(files, get_pdf_url, remove_file_index, get_file_pa
         auto_refresh=False,
     ) as live:
         while True:
+            preview = None
+            current = files[types[t_idx]][start:end]
+            if current and preview_file and not current[s_idxs[t_idx]].get("deleted"):
+                neighbours = current[max(s_idxs[t_idx] - 1, 0) : s_idxs[t_idx]]
+                neighbours += current[s_idxs[t_idx] + 1 : s_idxs[t_idx] + 2]
+                preview = preview_file(current[s_idxs[t_idx]], neighbours)
             live.update(
                 browse_panel(
                     files[types[t_idx]][start:end],
@@ -413,6 +719,7 @@ def console_loop_browse_panel(files, get_pdf_url, remove_file_index, get_file_pa
                     s_idxs[t_idx],
                     p_idxs[t_idx],
                     p_counts[t_idx],
+                    preview,
                 ),
                 refresh=True,
             )
@@ -466,6 +773,8 @@ def console_loop_browse_panel(files, get_pdf_url, remove_file_index, get_file_pa
 
 
 def console_loop_add_panel(vault: Vault, pdf_file_path: pathlib.Path):
+    from . import pdf
+
     if not pdf_file_path.exists() or not pdf_file_path.is_file():
         console.print(
             f"Error: PDF file does not exists: {pdf_file_path}",
@@ -488,7 +797,7 @@ def console_loop_add_panel(vault: Vault, pdf_file_path: pathlib.Path):
         metadata_keys += ["edition", "ISBN10", "ISBN13"]
     if pdf_type == "papers":
         metadata_keys += ["DOI", "journal", "volume", "pageRange", "keywords"]
-    ## TODO: Add page previewer
+    console.print(Panel(preview_document_page(pdf_file.document), title="Preview", expand=False))
     metadata = pdf_file.metadata
     metadata_dict = {}
     for key in metadata_keys:
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import json
+import pathlib
+import threading
+
+
+def normalize_query(query_str: str) -> str:
+    return " ".join(query_str.split())
+
+
+class QueryCache:
+    def __init__(self, maxsize=256, cache_path: str | pathlib.Path | None = None):
+        self.maxsize = maxsize
+        self.cache_path = pathlib.Path(cache_path) if cache_path else None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+        }
+
+    def load(self, versions: dict[str, tuple[str, int]]):
+        if self.cache_path is None or not self.cache_path.is_file():
+            return
+        try:
+            with open(self.cache_path) as f:
+                items = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return
+        for key, value in items:
+            key = tuple(key)
+            indexname, version = key[0], key[-2:]
+            if versions.get(indexname) == version:
+                self.put(key, value)
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        with self.lock:
+            items = [[list(key), value] for key, value in self.entries.items()]
+        with open(self.cache_path, "w") as f:
+            json.dump(items, f)
+
+
+class FilterCache:
+    def __init__(self):
+        self.generation = None
+        self.filters = {}
+        self.lock = threading.Lock()
+
+    def get(self, generation, key, compute):
+        with self.lock:
+            if generation != self.generation:
+                self.generation = generation
+                self.filters = {}
+            if key in self.filters:
+                return self.filters[key]
+        docs = compute()
+        with self.lock:
+            if generation == self.generation:
+                self.filters[key] = docs
+        return docs
+
+    def clear(self):
+        with self.lock:
+            self.generation = None
+            self.filters = {}
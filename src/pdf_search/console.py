@@ -1,3 +1,4 @@
 from rich.console import Console
 
 console = Console()
+error_console = Console(stderr=True)
\ No newline at end of file
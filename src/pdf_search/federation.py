@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+import pathlib
+
+from .vault import Vault
+
+
+class VaultGroup:
+    def __init__(
+        self,
+        vault_paths: list[str | pathlib.Path],
+        query_cache_size=256,
+        persist_query_cache=False,
+    ):
+        self.vaults = {}
+        for vault_path in vault_paths:
+            vault_name = pathlib.Path(vault_path).as_posix()
+            if vault_name not in self.vaults:
+                self.vaults[vault_name] = Vault(
+                    vault_path,
+                    query_cache_size=query_cache_size,
+                    persist_query_cache=persist_query_cache,
+                )
+        self.searchers = {
+            vault_name: vault.page_index.searcher() for vault_name, vault in self.vaults.items()
+        }
+        self.executor = ThreadPoolExecutor(max_workers=len(self.vaults))
+
+    @property
+    def primary(self) -> Vault:
+        return next(iter(self.vaults.values()))
+
+    def search_vault(self, vault_name, search_query_str, limit):
+        ## Each vault keeps its searcher open and only reopens it after a commit
+        searcher = self.searchers[vault_name].refresh()
+        self.searchers[vault_name] = searcher
+        pages = self.vaults[vault_name].search_pages(search_query_str, limit, searcher=searcher)
+        return [dict(page, vault=vault_name) for page in pages]
+
+    def search_pages(self, search_query_str, limit=10):
+        futures = [
+            self.executor.submit(self.search_vault, vault_name, search_query_str, limit)
+            for vault_name in self.vaults
+        ]
+        pages = [page for future in futures for page in future.result()]
+        pages.sort(key=lambda page: page["score"], reverse=True)
+        ## A file copied into several vaults is shown from the vault with its best page
+        file_vaults = {}
+        results = []
+        for page in pages:
+            if file_vaults.setdefault(page["file_id"], page["vault"]) == page["vault"]:
+                results.append(page)
+        return results[:limit]
+
+    def get_pdf_url(self, pdf_type, filename, vault_name=None) -> str:
+        vault = self.vaults[vault_name] if vault_name else self.primary
+        return vault.get_pdf_url(pdf_type, filename)
+
+    def preview_page(self, page, neighbours=()):
+        ## The selected page is queued before its neighbours so it is rendered first
+        for p in [page, *neighbours]:
+            self.vaults[p["vault"]].prefetch_page(
+                p["file_id"], p["pdf_type"], p["filename"], p["page_number"]
+            )
+        return self.vaults[page["vault"]].preview_page(
+            page["file_id"], page["pdf_type"], page["filename"], page["page_number"]
+        )
+
+    def cancel_previews(self):
+        for vault in self.vaults.values():
+            vault.cancel_previews()
+
+    def query_cache_stats(self) -> dict[str, dict]:
+        return {vault_name: vault.query_cache.stats() for vault_name, vault in self.vaults.items()}
+
+    def save_query_caches(self):
+        for vault in self.vaults.values():
+            vault.query_cache.save()
+
+    def close(self):
+        self.executor.shutdown()
+        for searcher in self.searchers.values():
+            searcher.close()
@@ -0,0 +1,125 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import os
+import pathlib
+import threading
+
+from rich.color import Color
+from rich.style import Style
+from rich.text import Text
+
+PREVIEW_DPI = 18
+PREVIEW_WIDTH = 32
+PREVIEW_CACHE_SIZE = 64 * 2**20
+
+## PyMuPDF is not thread safe, every page is rendered on this one thread
+renderer = ThreadPoolExecutor(max_workers=1)
+
+
+def pixmap_preview(samples: bytes, width: int, height: int, channels: int, columns=PREVIEW_WIDTH):
+    ## Each character shows two pixels, the upper half block is coloured by the top pixel
+    ## and its background by the bottom pixel
+    columns = min(columns, width)
+    rows = max(round(height * columns / width / 2), 1)
+    preview = Text()
+
+    def color(x, y):
+        pixel_y = min(y * height // (rows * 2), height - 1)
+        pixel_x = x * width // columns
+        offset = (pixel_y * width + pixel_x) * channels
+        return Color.from_rgb(*samples[offset : offset + 3])
+
+    for row in range(rows):
+        for column in range(columns):
+            preview.append(
+                "▀",
+                style=Style(color=color(column, row * 2), bgcolor=color(column, row * 2 + 1)),
+            )
+        preview.append("\n")
+    return preview
+
+
+def render_page(document, page_number, dpi=PREVIEW_DPI):
+    pixmap = document[page_number - 1].get_pixmap(dpi=dpi)
+    return pixmap_preview(pixmap.samples, pixmap.width, pixmap.height, pixmap.n)
+
+
+def preview_document_page(document, page_number=1, dpi=PREVIEW_DPI) -> Text:
+    try:
+        return renderer.submit(render_page, document, page_number, dpi).result()
+    except Exception as e:
+        return Text(f"Preview not available: {e}", style="red")
+
+
+class PreviewCache:
+    def __init__(self, cache_path: pathlib.Path, max_size=PREVIEW_CACHE_SIZE):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.size = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get_path(self, file_id, page_number, dpi) -> pathlib.Path:
+        return self.cache_path / f"{file_id}_{page_number}_{dpi}.png"
+
+    def render(self, file_id, pdf_file_path, page_number, dpi) -> Text:
+        import fitz
+
+        preview_path = self.get_path(file_id, page_number, dpi)
+        if preview_path.is_file():
+            os.utime(preview_path)
+            pixmap = fitz.Pixmap(str(preview_path))
+        else:
+            with fitz.open(pdf_file_path) as document:
+                pixmap = document[page_number - 1].get_pixmap(dpi=dpi)
+            self.cache_path.mkdir(exist_ok=True)
+            pixmap.save(str(preview_path))
+            self.evict(preview_path.stat().st_size)
+        return pixmap_preview(pixmap.samples, pixmap.width, pixmap.height, pixmap.n)
+
+    def evict(self, added_size):
+        if self.size is None:
+            self.size = sum(path.stat().st_size for path in self.cache_path.glob("*.png"))
+        else:
+            self.size += added_size
+        if self.size <= self.max_size:
+            return
+        ## Least recently shown previews are removed first
+        for path in sorted(self.cache_path.glob("*.png"), key=lambda path: path.stat().st_mtime):
+            if self.size <= self.max_size:
+                break
+            self.size -= path.stat().st_size
+            path.unlink()
+
+    def remove(self, file_id):
+        for path in self.cache_path.glob(f"{file_id}_*.png"):
+            path.unlink(missing_ok=True)
+        self.size = None
+
+    def request(self, file_id, pdf_file_path, page_number, dpi=PREVIEW_DPI) -> Future:
+        key = (file_id, page_number, dpi)
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None:
+                future = renderer.submit(self.render, file_id, pdf_file_path, page_number, dpi)
+                self.pending[key] = future
+                future.add_done_callback(lambda _: self.pending.pop(key, None))
+            return future
+
+    def cancel(self):
+        ## Queued renders are dropped and a running one is waited for, so that other
+        ## PyMuPDF work on the calling thread does not overlap with the renderer
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            future.cancel()
+        wait(futures)
+
+    def prefetch(self, file_id, pdf_file_path, page_number, dpi=PREVIEW_DPI):
+        if not self.get_path(file_id, page_number, dpi).is_file():
+            self.request(file_id, pdf_file_path, page_number, dpi)
+
+    def preview(self, file_id, pdf_file_path, page_number, dpi=PREVIEW_DPI) -> Text:
+        try:
+            return self.request(file_id, pdf_file_path, page_number, dpi).result()
+        except Exception as e:
+            return Text(f"Preview not available: {e}", style="red")
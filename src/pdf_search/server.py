@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import pathlib
+import queue
+from urllib.parse import parse_qs, urlparse
+
+from .vault import Vault, PDF_TYPES
+from .console import console
+
+
+class SearcherPool:
+    def __init__(self, vault: Vault, size=4):
+        self.vault = vault
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(
+                {
+                    "pages": vault.page_index.searcher(),
+                    "files": vault.file_index.searcher(),
+                }
+            )
+
+    @contextlib.contextmanager
+    def acquire(self):
+        searchers = self.idle.get()
+        try:
+            searchers = {name: searcher.refresh() for name, searcher in searchers.items()}
+            yield searchers
+        finally:
+            self.idle.put(searchers)
+
+    def close(self):
+        while not self.idle.empty():
+            for searcher in self.idle.get().values():
+                searcher.close()
+
+
+def add_pdf_file(vault: Vault, pdf_file_path: pathlib.Path, pdf_type: str, metadata: dict):
+    from . import pdf
+
+    if pdf_type not in PDF_TYPES:
+        raise ValueError(f"Invalid pdf type: {pdf_type}")
+    if not pdf_file_path.exists() or not pdf_file_path.is_file():
+        raise FileNotFoundError(f"PDF file does not exists: {pdf_file_path}")
+    pdf_file = pdf.PdfFile(vault, pdf_file_path)
+    pdf_file.pdf_type = pdf_type
+    metadata_dict = {key: pdf_file.metadata.get(key, "") for key in ["author", "title", "year"]}
+    metadata_dict.update(metadata)
+    pdf_file.update_metadata(metadata_dict)
+    pdf_file.write_file_index()
+    page_errors = pdf_file.write_page_index()
+    pdf_file.write()
+    return {
+        "file_id": pdf_file.file_hash,
+        "filename": pdf_file.generate_filename(),
+        "errors": {page_number: str(error) for page_number, error in page_errors.items()},
+    }
+
+
+def remove_pdf_file(vault: Vault, file_id: str):
+    file = vault.get_file(file_id)
+    if file is None:
+        raise FileNotFoundError(f"File not found: {file_id}")
+    files_deleted, pages_deleted = vault.remove_file_index(file_id)
+    vault.get_pdf_filepath(file["type"], file["filename"]).unlink(missing_ok=True)
+    return {"files_deleted": files_deleted, "pages_deleted": pages_deleted}
+
+
+class SearchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, vault: Vault, searchers=4):
+        super().__init__(address, SearchRequestHandler)
+        self.vault = vault
+        self.searcher_pool = SearcherPool(vault, searchers)
+        ## Whoosh allows a single writer per index, all changes go through one thread
+        self.writer = ThreadPoolExecutor(max_workers=1)
+
+    def server_close(self):
+        super().server_close()
+        self.writer.shutdown()
+        self.searcher_pool.close()
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    server: SearchServer
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def respond(self, handler):
+        try:
+            self.send_json(200, handler())
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {"error": str(e)})
+        except FileNotFoundError as e:
+            self.send_json(404, {"error": str(e)})
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        vault = self.server.vault
+        match url.path.strip("/").split("/"):
+            case ["pages"]:
+                self.respond(lambda: self.search(vault.search_pages, "pages", params))
+            case ["files"] if "q" in params:
+                self.respond(lambda: self.search(vault.search_files, "files", params))
+            case ["files"]:
+                self.respond(lambda: self.list_all_files())
+            case ["stats"]:
+                self.respond(lambda: vault.query_cache.stats())
+            case _:
+                self.send_json(404, {"error": f"Not found: {url.path}"})
+
+    def do_POST(self):
+        match urlparse(self.path).path.strip("/").split("/"):
+            case ["files"]:
+                self.respond(lambda: self.add_file(self.read_json()))
+            case _:
+                self.send_json(404, {"error": f"Not found: {self.path}"})
+
+    def do_DELETE(self):
+        match urlparse(self.path).path.strip("/").split("/"):
+            case ["files", file_id]:
+                self.respond(lambda: self.write(remove_pdf_file, file_id))
+            case _:
+                self.send_json(404, {"error": f"Not found: {self.path}"})
+
+    def search(self, search_method, indexname, params):
+        limit = int(params.get("limit", 10))
+        with self.server.searcher_pool.acquire() as searchers:
+            return search_method(params["q"], limit=limit, searcher=searchers[indexname])
+
+    def list_all_files(self):
+        with self.server.searcher_pool.acquire() as searchers:
+            return self.server.vault.list_all_files(searcher=searchers["files"])
+
+    def add_file(self, body):
+        pdf_file_path = pathlib.Path(body["path"])
+        return self.write(add_pdf_file, pdf_file_path, body["type"], body.get("metadata", {}))
+
+    def write(self, method, *args):
+        return self.server.writer.submit(method, self.server.vault, *args).result()
+
+    def log_message(self, format, *args):
+        console.log(f"{self.address_string()} {format % args}")
+
+
+def run_server(vault_path: pathlib.Path, host="127.0.0.1", port=8000, searchers=4, cache_size=256):
+    vault = Vault(vault_path, query_cache_size=cache_size)
+    server = SearchServer((host, port), vault, searchers)
+    console.print(f"Serving {vault_path} on http://{host}:{port} with {searchers} searchers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
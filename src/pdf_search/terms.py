@@ -0,0 +1,191 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+import json
+import pathlib
+import shutil
+import threading
+
+from whoosh.query import FuzzyTerm, Or, Term
+
+FUZZY_EXPANSIONS = 50
+## Shortest keyword allowed each number of edits, shorter keywords share too few trigrams
+## with their matches to rule out most of the dictionary
+FUZZY_MIN_LENGTHS = [0, 3, 7]
+TERMS_FORMAT_VERSION = 2
+
+
+def trigrams(term: str) -> list[str]:
+    padded = f"$${term}$"
+    return [padded[i : i + 3] for i in range(len(padded) - 2)]
+
+
+def edit_distance(a: str, b: str, maxdist: int) -> int:
+    if abs(len(a) - len(b)) > maxdist:
+        return maxdist + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > maxdist:
+            return maxdist + 1
+        previous = current
+    return previous[-1]
+
+
+class TrigramIndex:
+    def __init__(self, terms, grams=None):
+        ## Terms are ordered by length, so the postings of a gram are too
+        self.terms = sorted(terms, key=lambda term: (len(term), term)) if grams is None else terms
+        if grams is not None:
+            self.grams = grams
+            return
+        grams = defaultdict(lambda: array("I"))
+        for term_id, term in enumerate(self.terms):
+            for gram in set(trigrams(term)):
+                grams[gram].append(term_id)
+        self.grams = dict(grams)
+
+    def candidates(self, text, maxdist):
+        ## Only terms within maxdist of the length of text are counted
+        first = bisect_left(self.terms, len(text) - maxdist, key=len)
+        last = bisect_right(self.terms, len(text) + maxdist, key=len)
+        counts = Counter()
+        grams = set(trigrams(text))
+        for gram in grams:
+            postings = self.grams.get(gram, ())
+            counts.update(postings[bisect_left(postings, first) : bisect_left(postings, last)])
+        ## An edit changes at most three trigrams of a term
+        min_shared = len(grams) - 3 * maxdist
+        return (self.terms[term_id] for term_id, n in counts.items() if n >= min_shared)
+
+    def terms_within(self, text, maxdist, prefixlength=0):
+        maxdist = max(
+            distance
+            for distance, min_length in enumerate(FUZZY_MIN_LENGTHS[: maxdist + 1])
+            if len(text) >= min_length
+        )
+        prefix = text[:prefixlength]
+        for term in self.candidates(text, maxdist):
+            if term.startswith(prefix):
+                distance = edit_distance(text, term, maxdist)
+                if distance <= maxdist:
+                    yield term, distance
+
+    def save(self, terms_path: pathlib.Path, segment_id):
+        ## The postings of all grams are written as one array, the table holds their offsets
+        postings = array("I")
+        table = {}
+        for gram, term_ids in self.grams.items():
+            table[gram] = [len(postings), len(term_ids)]
+            postings.extend(term_ids)
+        with open(terms_path / f"{segment_id}.postings", "wb") as f:
+            postings.tofile(f)
+        ## The table is written last, a segment without it is rebuilt from the index
+        with open(terms_path / f"{segment_id}.json", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": TERMS_FORMAT_VERSION,
+                    "terms": self.terms,
+                    "grams": table,
+                    "size": len(postings),
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, terms_path: pathlib.Path, segment_id):
+        with open(terms_path / f"{segment_id}.json", encoding="utf-8") as f:
+            table = json.load(f)
+        postings = array("I")
+        with open(terms_path / f"{segment_id}.postings", "rb") as f:
+            postings.frombytes(f.read())
+        if table.get("version") != TERMS_FORMAT_VERSION:
+            raise ValueError(f"Outdated term postings for segment {segment_id}")
+        if len(postings) != table["size"]:
+            raise ValueError(f"Incomplete term postings for segment {segment_id}")
+        grams = {
+            gram: postings[offset : offset + count]
+            for gram, (offset, count) in table["grams"].items()
+        }
+        return cls(table["terms"], grams)
+
+
+class TermDictionary:
+    def __init__(self, terms_path: pathlib.Path, fieldname="text"):
+        self.terms_path = terms_path
+        self.fieldname = fieldname
+        self.segments = {}
+        self.lock = threading.Lock()
+
+    def segment_readers(self, reader) -> dict:
+        ## An empty index has no segments to read terms from
+        leaf_readers = reader.leaf_readers() if reader.doc_count_all() else []
+        return {
+            segment_reader.segment().segment_id(): segment_reader
+            for segment_reader, _ in leaf_readers
+        }
+
+    def segment_indexes(self, reader) -> list[TrigramIndex]:
+        segment_readers = self.segment_readers(reader)
+        with self.lock:
+            if segment_readers.keys() != self.segments.keys() or not self.segments:
+                self.segments = {
+                    segment_id: self.segments.get(segment_id)
+                    or self.load_segment(segment_id, segment_reader)
+                    for segment_id, segment_reader in segment_readers.items()
+                }
+                self.remove_stale_segments(self.segments)
+            return list(self.segments.values())
+
+    def prune_segments(self, reader):
+        ## Drops the terms of merged segments without indexing the segments that replaced them
+        segment_readers = self.segment_readers(reader)
+        with self.lock:
+            self.segments = {
+                segment_id: trigram_index
+                for segment_id, trigram_index in self.segments.items()
+                if segment_id in segment_readers
+            }
+            self.remove_stale_segments(segment_readers)
+
+    def clear(self):
+        with self.lock:
+            self.segments = {}
+            shutil.rmtree(self.terms_path, ignore_errors=True)
+
+    def remove_stale_segments(self, live_segment_ids):
+        ## Segments merged away by any process leave their files behind
+        for path in self.terms_path.glob("*"):
+            segment_id, _, suffix = path.name.partition(".")
+            if segment_id not in live_segment_ids or suffix not in ("json", "postings"):
+                path.unlink(missing_ok=True)
+
+    def load_segment(self, segment_id, segment_reader) -> TrigramIndex:
+        try:
+            return TrigramIndex.load(self.terms_path, segment_id)
+        except (OSError, ValueError, KeyError):
+            pass
+        trigram_index = TrigramIndex(segment_reader.field_terms(self.fieldname))
+        self.terms_path.mkdir(exist_ok=True)
+        trigram_index.save(self.terms_path, segment_id)
+        return trigram_index
+
+    def terms_within(self, reader, text, maxdist, prefixlength=0) -> list[str]:
+        distances = {}
+        for trigram_index in self.segment_indexes(reader):
+            for term, distance in trigram_index.terms_within(text, maxdist, prefixlength):
+                distances[term] = min(distance, distances.get(term, distance))
+        return sorted(distances, key=lambda term: (distances[term], term))
+
+    def expand_fuzzy_terms(self, query, reader):
+        def expand(q):
+            if isinstance(q, FuzzyTerm) and q.fieldname == self.fieldname:
+                terms = self.terms_within(reader, q.text.lower(), q.maxdist, q.prefixlength)
+                return Or(
+                    [Term(q.fieldname, term) for term in terms[:FUZZY_EXPANSIONS]], boost=q.boost
+                )
+            return q
+
+        return query.accept(expand)
@@ -0,0 +1,29 @@
+import gzip
+import json
+import pathlib
+
+
+class TextStore:
+    def __init__(self, store_path: pathlib.Path):
+        self.store_path = store_path
+
+    def get_path(self, file_id) -> pathlib.Path:
+        return self.store_path / f"{file_id}.json.gz"
+
+    def has(self, file_id) -> bool:
+        return self.get_path(file_id).is_file()
+
+    def read(self, file_id) -> dict[int, str]:
+        with gzip.open(self.get_path(file_id), "rt", encoding="utf-8") as f:
+            pages = json.load(f)
+        return {int(page_number): text for page_number, text in pages.items()}
+
+    def write(self, file_id, pages: dict[int, str]):
+        if self.has(file_id):
+            pages = self.read(file_id) | pages
+        self.store_path.mkdir(exist_ok=True)
+        with gzip.open(self.get_path(file_id), "wt", encoding="utf-8") as f:
+            json.dump({str(page_number): text for page_number, text in pages.items()}, f)
+
+    def remove(self, file_id):
+        self.get_path(file_id).unlink(missing_ok=True)
@@ -1,24 +1,39 @@
+import functools
+import hashlib
 import io
+import os
 import pathlib
 import shutil
 import tokenize
 from urllib.parse import quote
+import uuid
 
 import pegen.tokenizer
 import pegen.utils
 
 from whoosh import fields as f
 from whoosh.analysis import StandardAnalyzer
-from whoosh.qparser import QueryParser, MultifieldParser
+from whoosh.qparser import FuzzyTermPlugin, QueryParser, MultifieldParser
+from whoosh.idsets import BitSet
 from whoosh.query import Every
+from whoosh.writing import MERGE_SMALL, NO_MERGE, OPTIMIZE
 from whoosh import index
 
+from .cache import FilterCache, QueryCache, normalize_query
 from .console import console
+from .preview import PreviewCache
+from .terms import TermDictionary
+from .textstore import TextStore
 
 PDF_TYPES = ["books", "papers", "thesis", "docs"]
+MERGE_POLICIES = {"none": NO_MERGE, "small": MERGE_SMALL, "optimize": OPTIMIZE}
+FILTER_FIELDS = ["pdf_type", "authors"]
+QUERY_CACHE_FILENAME = "query_cache.json"
+INDEX_ID_FILENAME = "index_id"
 
 
-def build_search_query(source_string):
+@functools.cache
+def search_query_parser():
     grammer = """
     start: t=text_query? f=field_query_pair*    { [ t , *f ] if t else f }
     text_query: query                           { ( 'text', ' '.join(query) ) }
@@ -29,22 +44,71 @@ def build_search_query(source_string):
         | 'file'                                { 'filename' }
         | 'type'                                { 'pdf_type' } 
     atom:
+        | fuzzy_atom
+        | n=NAME '~'                            { n.string + '~' }
+        | n=NAME '*'                            { n.string + '*' }
         | NAME                                  { name.string }
         | NUMBER                                { number.string }
+    fuzzy_atom:
+        | n=NAME t='~' d=NUMBER                 { n.string + '~' + str(min(int(d.string), 2))
+                                                  if d.start == t.end and d.string.isdigit()
+                                                  else None }
     """
+    return pegen.utils.make_parser(grammer)
+
 
+def parse_search_query(source_string) -> list[tuple[str, str]]:
     file = io.StringIO(source_string)
-    parser_class = pegen.utils.make_parser(grammer)
+    parser_class = search_query_parser()
     tokengen = tokenize.generate_tokens(file.readline)
     tokenizer = pegen.tokenizer.Tokenizer(tokengen, verbose=False)
     parser = parser_class(tokenizer, verbose=False)
     cst = parser.start()
+    if cst is None:
+        raise ValueError(f"Invalid search query: {source_string}")
+    return cst
+
+
+def build_search_query(source_string):
     queries = []
-    for field, words in cst:
+    for field, words in parse_search_query(source_string):
         queries.append(f"{field}:({words})")
     return " ".join(queries)
 
 
+def create_vault_index(index_path: pathlib.Path):
+    pages_schema = f.Schema(
+        id=f.ID(stored=True, unique=True),
+        text=f.TEXT(analyzer=StandardAnalyzer()),
+        filename=f.TEXT(stored=True, analyzer=StandardAnalyzer()),
+        authors=f.TEXT(stored=True, analyzer=StandardAnalyzer()),
+        pdf_type=f.ID(stored=True),
+        page_number=f.NUMERIC(stored=True),
+        file_id=f.ID(stored=True),
+    )
+    files_schema = f.Schema(
+        id=f.ID(stored=True, unique=True),
+        type=f.ID(stored=True),
+        title=f.TEXT(stored=True, analyzer=StandardAnalyzer()),
+        authors=f.IDLIST(stored=True),
+        year=f.ID(stored=True),
+        doi=f.ID(stored=True),
+        edition=f.ID(stored=True),
+        isbn10=f.ID(stored=True),
+        isbn13=f.ID(stored=True),
+        journal=f.ID(stored=True),
+        volume=f.ID(stored=True),
+        pages=f.ID(stored=True),
+        keywords=f.KEYWORD(stored=True, commas=True),
+        filename=f.ID(stored=True),
+    )
+    file_index = index.create_in(index_path, files_schema, "files")
+    page_index = index.create_in(index_path, pages_schema, "pages")
+    ## Generations restart with every new index, the id tells rebuilt indexes apart
+    (index_path / INDEX_ID_FILENAME).write_text(uuid.uuid4().hex)
+    return file_index, page_index
+
+
 def check_status_ok(method):
     def modified_method(self, *args, **kwargs):
         if not self.status_ok:
@@ -55,11 +119,23 @@ def check_status_ok(method):
 
 
 class Vault:
-    def __init__(self, vault_path: str | pathlib.Path):
+    def __init__(
+        self,
+        vault_path: str | pathlib.Path,
+        query_cache_size=256,
+        persist_query_cache=False,
+    ):
         self.vault_path = pathlib.Path(vault_path)
         self.file_index = None
         self.page_index = None
+        cache_path = self.vault_path / QUERY_CACHE_FILENAME if persist_query_cache else None
+        self.query_cache = QueryCache(query_cache_size, cache_path)
+        self.filter_cache = FilterCache()
+        self.term_dictionary = TermDictionary(self.vault_path / "terms")
+        self.text_store = TextStore(self.vault_path / "text")
+        self.preview_cache = PreviewCache(self.vault_path / "previews")
         self.load_vault()
+        self.query_cache.load(self.index_versions())
 
     def check_vault_status(self) -> bool:
         if not self.vault_path.exists() or not self.vault_path.is_dir():
@@ -69,33 +145,7 @@ class Vault:
         created = []
         if not index_path.exists() or not index_path.is_dir():
             index_path.mkdir()
-            pages_schema = f.Schema(
-                id=f.ID(stored=True, unique=True),
-                text=f.TEXT(analyzer=StandardAnalyzer()),
-                filename=f.TEXT(stored=True, analyzer=StandardAnalyzer()),
-                authors=f.TEXT(stored=True, analyzer=StandardAnalyzer()),
-                pdf_type=f.ID(stored=True),
-                page_number=f.NUMERIC(stored=True),
-                file_id=f.ID(stored=True),
-            )
-            files_schema = f.Schema(
-                id=f.ID(stored=True, unique=True),
-                type=f.ID(stored=True),
-                title=f.TEXT(stored=True, analyzer=StandardAnalyzer()),
-                authors=f.IDLIST(stored=True),
-                year=f.ID(stored=True),
-                doi=f.ID(stored=True),
-                edition=f.ID(stored=True),
-                isbn10=f.ID(stored=True),
-                isbn13=f.ID(stored=True),
-                journal=f.ID(stored=True),
-                volume=f.ID(stored=True),
-                pages=f.ID(stored=True),
-                keywords=f.KEYWORD(stored=True, commas=True),
-                filename=f.ID(stored=True),
-            )
-            index.create_in(index_path, pages_schema, "pages")
-            index.create_in(index_path, files_schema, "files")
+            create_vault_index(index_path)
             created.append("index")
         for pdf_type in PDF_TYPES:
             type_path = self.vault_path / pdf_type
@@ -116,6 +166,26 @@ class Vault:
             self.file_index = index.open_dir(index_path, "files")
         if not self.page_index:
             self.page_index = index.open_dir(index_path, "pages")
+        index_id_path = index_path / INDEX_ID_FILENAME
+        if not index_id_path.is_file():
+            index_id_path.write_text(uuid.uuid4().hex)
+        self.index_id = index_id_path.read_text().strip()
+
+    def index_versions(self) -> dict[str, tuple[str, int]]:
+        return {
+            "pages": (self.index_id, self.page_index.latest_generation()),
+            "files": (self.index_id, self.file_index.latest_generation()),
+        }
+
+    def cached_search(self, indexname, query_str, limit, search, generation=None):
+        if generation is None:
+            generation = self.index_versions()[indexname][1]
+        key = (indexname, normalize_query(query_str), limit, self.index_id, generation)
+        results = self.query_cache.get(key)
+        if results is None:
+            results = search()
+            self.query_cache.put(key, results)
+        return results
 
     @check_status_ok
     def write_file_index(self, fields):
@@ -130,9 +200,17 @@ class Vault:
     @check_status_ok
     def write_multiple_page_index(self, pages, track=lambda x: x):
         page_writer = self.page_index.writer()
+        texts = {}
         for page_fields in track(pages):
             page_writer.add_document(**page_fields)
+            if "file_id" in page_fields and "page_number" in page_fields:
+                file_texts = texts.setdefault(page_fields["file_id"], {})
+                file_texts[page_fields["page_number"]] = page_fields["text"]
         page_writer.commit()
+        for file_id, file_texts in texts.items():
+            self.text_store.write(file_id, file_texts)
+        with self.page_index.reader() as reader:
+            self.term_dictionary.segment_indexes(reader)
 
     @check_status_ok
     def write_page_index(self, page_id, text, pdf_type, filename, authors):
@@ -153,6 +231,17 @@ class Vault:
             raise ValueError("pdf_type cannot be None")
         return self.vault_path / pdf_type / filename
 
+    def preview_page(self, file_id, pdf_type, filename, page_number=1):
+        pdf_file_path = self.get_pdf_filepath(pdf_type, filename)
+        return self.preview_cache.preview(file_id, pdf_file_path, page_number)
+
+    def prefetch_page(self, file_id, pdf_type, filename, page_number=1):
+        pdf_file_path = self.get_pdf_filepath(pdf_type, filename)
+        self.preview_cache.prefetch(file_id, pdf_file_path, page_number)
+
+    def cancel_previews(self):
+        self.preview_cache.cancel()
+
     @check_status_ok
     def remove_file_index(self, file_id):
         page_writer = self.page_index.writer()
@@ -161,27 +250,63 @@ class Vault:
         file_writer = self.file_index.writer()
         files_deleted = file_writer.delete_by_term("id", file_id)
         file_writer.commit()
+        self.text_store.remove(file_id)
+        self.preview_cache.remove(file_id)
         return files_deleted, pages_deleted
 
     @check_status_ok
-    def search_pages(self, search_query_str, limit=10):
-        query_str = build_search_query(search_query_str)
-        page_text_query = MultifieldParser(
+    def search_pages(self, search_query_str, limit=10, searcher=None):
+        generation = searcher.reader().generation() if searcher is not None else None
+        pages = self.cached_search(
+            "pages",
+            search_query_str,
+            limit,
+            lambda: self._search_pages(search_query_str, limit, searcher),
+            generation,
+        )
+        return [dict(page) for page in pages]
+
+    def _search_pages(self, search_query_str, limit, searcher=None):
+        if searcher is None:
+            with self.page_index.searcher() as s:
+                return self._search_pages(search_query_str, limit, s)
+        parser = MultifieldParser(
             ["text", "filename", "pdf_type", "authors"], self.page_index.schema
-        ).parse(query_str)
+        )
+        parser.add_plugin(FuzzyTermPlugin())
+        ## type and author only restrict the pages, they are applied as cached filters
+        queries = []
+        page_filter = None
+        for field, words in parse_search_query(search_query_str):
+            if field in FILTER_FIELDS:
+                field_filter = self.page_filter(searcher, parser, field, words)
+                page_filter = field_filter if page_filter is None else page_filter & field_filter
+            else:
+                queries.append(f"{field}:({words})")
+        ## whoosh ignores an empty filter instead of matching no pages
+        if page_filter is not None and not page_filter:
+            return []
+        if queries:
+            page_text_query = self.term_dictionary.expand_fuzzy_terms(
+                parser.parse(" ".join(queries)), searcher.reader()
+            )
+        elif page_filter is not None:
+            page_text_query = Every()
+        else:
+            return []
         # page_text_query = QueryParser("text", self.page_index.schema).parse(search_query_str)
         results = []
-        with self.page_index.searcher() as s:
-            pages = s.search(page_text_query, limit=limit)
-            for page in pages:
-                results.append(
-                    {
-                        "file_id": page["file_id"],
-                        "filename": page["filename"],
-                        "pdf_type": page["pdf_type"],
-                        "page_number": page["page_number"],
-                    }
-                )
+        pages = searcher.search(page_text_query, limit=limit, filter=page_filter)
+        for page in pages:
+            results.append(
+                {
+                    "file_id": page["file_id"],
+                    "filename": page["filename"],
+                    "pdf_type": page["pdf_type"],
+                    "page_number": page["page_number"],
+                    "score": page.score,
+                }
+            )
         # file_query_str = " OR ".join(set([page["file_id"] for page in results]))
         # file_title_query = QueryParser("id", self.file_index.schema).parse(file_query_str)
         # file_map = {}
@@ -197,33 +322,199 @@ class Vault:
         #     page["pdf_type"] = file_map[page["file_id"]]["pdf_type"]
         return results
 
+    def page_filter(self, searcher, parser, field, words) -> BitSet:
+        def docs_for_filter():
+            filter_query = parser.parse(f"{field}:({words})")
+            return BitSet(searcher.docs_for_query(filter_query), size=searcher.doc_count_all())
+
+        generation = searcher.reader().generation()
+        return self.filter_cache.get(generation, (field, words), docs_for_filter)
+
     @check_status_ok
-    def search_files(self, query_str, limit=10):
+    def search_files(self, query_str, limit=10, searcher=None):
+        generation = searcher.reader().generation() if searcher is not None else None
+        files = self.cached_search(
+            "files",
+            query_str,
+            limit,
+            lambda: self._search_files(query_str, limit, searcher),
+            generation,
+        )
+        return {pdf_type: [dict(file) for file in fs] for pdf_type, fs in files.items()}
+
+    def _search_files(self, query_str, limit, searcher=None):
+        if searcher is None:
+            with self.file_index.searcher() as s:
+                return self._search_files(query_str, limit, s)
         file_title_query = QueryParser("title", self.file_index.schema).parse(query_str)
         results = {}
-        with self.file_index.searcher() as s:
-            files = s.search(file_title_query, limit=limit)
-            for file in files:
-                pdf_type = file["type"]
-                if pdf_type not in results:
-                    results[pdf_type] = []
-                results[pdf_type].append(dict(file))
+        files = searcher.search(file_title_query, limit=limit)
+        for file in files:
+            pdf_type = file["type"]
+            if pdf_type not in results:
+                results[pdf_type] = []
+            results[pdf_type].append(dict(file))
         return results
 
     @check_status_ok
-    def list_all_files(self):
+    def list_all_files(self, searcher=None):
+        if searcher is None:
+            with self.file_index.searcher() as s:
+                return self.list_all_files(s)
         file_title_query = Every()
         results = {}
-        with self.file_index.searcher() as s:
-            files = s.search(file_title_query, limit=1000)
-            for file in files:
-                pdf_type = file["type"]
-                if pdf_type not in results:
-                    results[pdf_type] = []
-                results[pdf_type].append(dict(file))
+        files = searcher.search(file_title_query, limit=1000)
+        for file in files:
+            pdf_type = file["type"]
+            if pdf_type not in results:
+                results[pdf_type] = []
+            results[pdf_type].append(dict(file))
         return results
 
+    @check_status_ok
+    def get_file(self, file_id, searcher=None):
+        if searcher is None:
+            with self.file_index.searcher() as s:
+                return self.get_file(file_id, s)
+        file = searcher.document(id=file_id)
+        return dict(file) if file else None
+
+    @check_status_ok
+    def index_health(self) -> dict[str, dict]:
+        index_path = self.vault_path / "index"
+        health = {}
+        for indexname, ix in [("pages", self.page_index), ("files", self.file_index)]:
+            with ix.reader() as reader:
+                documents = reader.doc_count()
+                all_documents = reader.doc_count_all()
+                segments = len(reader.leaf_readers()) if all_documents else 0
+            size = sum(
+                path.stat().st_size
+                for path in index_path.iterdir()
+                if path.name.startswith((f"{indexname}_", f"_{indexname}_"))
+            )
+            health[indexname] = {
+                "segments": segments,
+                "documents": documents,
+                "deleted": all_documents - documents,
+                "deleted_ratio": (
+                    (all_documents - documents) / all_documents if all_documents else 0.0
+                ),
+                "size": size,
+            }
+        return health
+
+    @check_status_ok
+    def find_orphans(self) -> dict[str, list]:
+        with self.file_index.reader() as reader:
+            files = {fields["id"]: fields for fields in reader.all_stored_fields()}
+        with self.page_index.reader() as reader:
+            page_file_ids = {fields.get("file_id") for fields in reader.all_stored_fields()}
+        page_file_ids.discard(None)
+        indexed_paths = {
+            self.get_pdf_filepath(file["type"], file["filename"]) for file in files.values()
+        }
+        return {
+            "pages": sorted(page_file_ids - files.keys()),
+            "files": sorted(
+                file_id
+                for file_id, file in files.items()
+                if not self.get_pdf_filepath(file["type"], file["filename"]).is_file()
+            ),
+            "untracked": sorted(
+                path
+                for pdf_type in PDF_TYPES
+                for path in (self.vault_path / pdf_type).glob("*.pdf")
+                if path not in indexed_paths
+            ),
+        }
+
+    @check_status_ok
+    def maintain_index(self, merge="small", dry_run=False):
+        if merge not in MERGE_POLICIES:
+            raise ValueError(f"Invalid merge policy: {merge}")
+        orphans = self.find_orphans()
+        if dry_run:
+            return orphans, 0, 0
+        ## Pages of files without a pdf are removed along with the file index
+        page_writer = self.page_index.writer()
+        pages_deleted = 0
+        for file_id in orphans["pages"] + orphans["files"]:
+            pages_deleted += page_writer.delete_by_term("file_id", file_id)
+        page_writer.commit(mergetype=MERGE_POLICIES[merge])
+        file_writer = self.file_index.writer()
+        files_deleted = 0
+        for file_id in orphans["files"]:
+            files_deleted += file_writer.delete_by_term("id", file_id)
+        file_writer.commit(mergetype=MERGE_POLICIES[merge])
+        with self.page_index.reader() as reader:
+            self.term_dictionary.prune_segments(reader)
+        for file_id in orphans["pages"] + orphans["files"]:
+            self.text_store.remove(file_id)
+            self.preview_cache.remove(file_id)
+        return orphans, files_deleted, pages_deleted
+
+    @check_status_ok
+    def reindex(self, procs=None, allow_missing=False, track=lambda x: x):
+        with self.file_index.reader() as reader:
+            files = list(reader.all_stored_fields())
+        missing = {file["id"] for file in files if not self.text_store.has(file["id"])}
+        if missing and not allow_missing:
+            raise Exception(
+                f"Stored text not found for {len(missing)} files, add them again to the vault"
+            )
+        new_index_path = self.vault_path / "index.new"
+        if new_index_path.exists():
+            shutil.rmtree(new_index_path)
+        new_index_path.mkdir()
+        file_index, page_index = create_vault_index(new_index_path)
+        file_field_names = file_index.schema.names()
+        file_writer = file_index.writer()
+        for file in files:
+            file_writer.add_document(**{k: v for k, v in file.items() if k in file_field_names})
+        file_writer.commit()
+        ## Pages are tokenized in parallel by whoosh's multiprocessing writer
+        procs = procs or os.cpu_count() or 1
+        if procs > 1:
+            page_writer = page_index.writer(procs=procs, multisegment=True)
+        else:
+            page_writer = page_index.writer()
+        pages_indexed = 0
+        for file in track([file for file in files if file["id"] not in missing]):
+            for page_number, text in self.text_store.read(file["id"]).items():
+                page_writer.add_document(
+                    id=hashlib.sha1(text.encode()).hexdigest(),
+                    text=text,
+                    file_id=file["id"],
+                    filename=file["filename"],
+                    pdf_type=file["type"],
+                    page_number=page_number,
+                    authors=file.get("authors", ""),
+                )
+                pages_indexed += 1
+        page_writer.commit()
+        index_path = self.vault_path / "index"
+        old_index_path = self.vault_path / "index.old"
+        self.file_index = None
+        self.page_index = None
+        index_path.rename(old_index_path)
+        new_index_path.rename(index_path)
+        shutil.rmtree(old_index_path)
+        ## A rebuilt index starts its generations again, cached results would be mistaken as current
+        self.query_cache.clear()
+        (self.vault_path / QUERY_CACHE_FILENAME).unlink(missing_ok=True)
+        self.filter_cache.clear()
+        self.term_dictionary.clear()
+        self.load_vault()
+        return len(files) - len(missing), pages_indexed, missing
+
     def nuke(self):
+        self.query_cache.clear()
+        self.filter_cache.clear()
+        (self.vault_path / QUERY_CACHE_FILENAME).unlink(missing_ok=True)
         shutil.rmtree(self.vault_path / "index")
+        shutil.rmtree(self.vault_path / "terms", ignore_errors=True)
+        shutil.rmtree(self.vault_path / "text", ignore_errors=True)
+        shutil.rmtree(self.vault_path / "previews", ignore_errors=True)
         for pdf_type in PDF_TYPES:
             shutil.rmtree(self.vault_path / pdf_type)